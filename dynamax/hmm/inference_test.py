@@ -1,7 +1,10 @@
 import pytest
 import itertools as it
+from functools import partial
+import jax
 import jax.numpy as jnp
 import jax.random as jr
+from jax.experimental import enable_x64
 import dynamax.hmm.inference as core
 import dynamax.hmm.parallel_inference as parallel
 
@@ -306,3 +309,223 @@ def test_parallel_smoother(key=0, num_timesteps=100, num_states=3):
     posterior = core.hmm_smoother(initial_probs, transition_matrix, log_likelihoods)
     posterior2 = parallel.hmm_smoother(initial_probs, transition_matrix, log_likelihoods)
     assert jnp.allclose(posterior.smoothed_probs, posterior2.smoothed_probs, atol=1e-1)
+
+
+def test_parallel_log_filter(key=0, num_timesteps=100, num_states=3):
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+
+    initial_probs, transition_matrix, log_likelihoods = \
+        random_hmm_args(key, num_timesteps, num_states)
+
+    posterior = parallel.hmm_filter(initial_probs, transition_matrix, log_likelihoods)
+    posterior2 = parallel.log_hmm_filter(jnp.log(initial_probs), jnp.log(transition_matrix), log_likelihoods)
+    assert jnp.allclose(posterior.marginal_loglik, posterior2.marginal_loglik, atol=1e-3)
+    assert jnp.allclose(posterior.filtered_probs, posterior2.filtered_probs, atol=1e-3)
+    assert jnp.allclose(posterior.predicted_probs, posterior2.predicted_probs, atol=1e-3)
+
+
+def test_parallel_backward_filter(key=0, num_timesteps=100, num_states=3):
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+
+    initial_probs, transition_matrix, log_likelihoods = \
+        random_hmm_args(key, num_timesteps, num_states)
+
+    log_normalizer, backward_pred_probs = core.hmm_backward_filter(transition_matrix, log_likelihoods)
+    log_normalizer2, backward_pred_probs2 = parallel.hmm_backward_filter(transition_matrix, log_likelihoods)
+    backward_pred_probs /= backward_pred_probs.sum(axis=1, keepdims=True)
+    assert jnp.allclose(log_normalizer, log_normalizer2, atol=1e-3)
+    assert jnp.allclose(backward_pred_probs, backward_pred_probs2, atol=1e-3)
+
+
+def test_parallel_smoother_methods(key=0, num_timesteps=100, num_states=3):
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+
+    initial_probs, transition_matrix, log_likelihoods = \
+        random_hmm_args(key, num_timesteps, num_states)
+
+    posterior = parallel.hmm_smoother(initial_probs, transition_matrix, log_likelihoods, method="autodiff")
+    posterior2 = parallel.hmm_smoother(initial_probs, transition_matrix, log_likelihoods, method="two_filter")
+    assert jnp.allclose(posterior.marginal_loglik, posterior2.marginal_loglik, atol=1e-3)
+    assert jnp.allclose(posterior.smoothed_probs, posterior2.smoothed_probs, atol=1e-3)
+    assert jnp.allclose(posterior.trans_probs, posterior2.trans_probs, atol=1e-3)
+
+
+def test_parallel_smoother_long_sequence(key=0, num_timesteps=3000, num_states=10):
+    """ The two-filter smoother stays accurate in float32 over long, informative sequences."""
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+
+    initial_probs, transition_matrix, log_likelihoods = \
+        random_hmm_args(key, num_timesteps, num_states, scale=10.0)
+
+    with enable_x64():
+        args64 = tuple(np.asarray(x, dtype=np.float64) for x in (initial_probs, transition_matrix, log_likelihoods))
+        posterior = core.hmm_smoother(*args64)
+        _, backward_pred_probs = core.hmm_backward_filter(*args64[1:])
+        smoothed_probs = np.asarray(posterior.smoothed_probs)
+        backward_pred_probs = np.asarray(backward_pred_probs / backward_pred_probs.sum(axis=1, keepdims=True))
+
+    _, backward_pred_probs2 = parallel.hmm_backward_filter(transition_matrix, log_likelihoods)
+    posterior2 = parallel.hmm_smoother(initial_probs, transition_matrix, log_likelihoods)
+    assert jnp.allclose(backward_pred_probs, backward_pred_probs2, atol=1e-5)
+    assert jnp.allclose(smoothed_probs, posterior2.smoothed_probs, atol=1e-5)
+
+
+def test_parallel_smoother_logspace(key=0, num_timesteps=100, num_states=3):
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+
+    initial_probs, transition_matrix, log_likelihoods = \
+        random_hmm_args(key, num_timesteps, num_states)
+
+    posterior = core.hmm_smoother(initial_probs, transition_matrix, log_likelihoods)
+    posterior2 = parallel.hmm_smoother_logspace(jnp.log(initial_probs), jnp.log(transition_matrix), log_likelihoods)
+    assert jnp.allclose(posterior.marginal_loglik, posterior2.marginal_loglik, atol=1e-3)
+    assert jnp.allclose(posterior.smoothed_probs, posterior2.smoothed_probs, atol=1e-3)
+
+
+def test_parallel_smoother_sparse_transitions(key=0, num_timesteps=50, num_states=4):
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+
+    initial_probs, transition_matrix, log_likelihoods = \
+        random_hmm_args(key, num_timesteps, num_states)
+    transition_matrix *= jnp.eye(num_states) + jnp.eye(num_states, k=1) + jnp.eye(num_states, k=1-num_states)
+    transition_matrix /= transition_matrix.sum(1, keepdims=True)
+
+    posterior = core.hmm_smoother(initial_probs, transition_matrix, log_likelihoods)
+    for method in ["two_filter", "autodiff"]:
+        posterior2 = parallel.hmm_smoother(initial_probs, transition_matrix, log_likelihoods, method=method)
+        assert jnp.allclose(posterior.smoothed_probs, posterior2.smoothed_probs, atol=1e-3)
+
+
+def test_parallel_filter_remat(key=0, num_timesteps=100, num_states=3):
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+
+    initial_probs, transition_matrix, log_likelihoods = \
+        random_hmm_args(key, num_timesteps, num_states)
+
+    def marginal_loglik(transition_matrix, log_likelihoods, remat):
+        return parallel.hmm_filter(initial_probs, transition_matrix, log_likelihoods, remat=remat).marginal_loglik
+
+    grad_fn = jax.grad(marginal_loglik, argnums=(0, 1))
+    grads = grad_fn(transition_matrix, log_likelihoods, remat=False)
+    grads_remat = grad_fn(transition_matrix, log_likelihoods, remat=True)
+    for g, g_remat in zip(grads, grads_remat):
+        assert jnp.allclose(g, g_remat, atol=1e-5)
+
+
+def test_parallel_filter_dtype(key=0, num_timesteps=500, num_states=6):
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+
+    with enable_x64():
+        initial_probs, transition_matrix, log_likelihoods = \
+            (x.astype(jnp.float64) for x in random_hmm_args(key, num_timesteps, num_states, scale=3.0))
+        posterior = core.hmm_filter(initial_probs, transition_matrix, log_likelihoods)
+
+        # Messages stored in float32, outputs cast back to float64
+        posterior2 = parallel.hmm_filter(initial_probs, transition_matrix, log_likelihoods, dtype=jnp.float32)
+        assert posterior2.marginal_loglik.dtype == jnp.float64
+        assert posterior2.filtered_probs.dtype == jnp.float64
+        assert jnp.allclose(posterior.marginal_loglik, posterior2.marginal_loglik, atol=1e-3)
+        assert jnp.allclose(posterior.filtered_probs, posterior2.filtered_probs, atol=1e-5)
+
+        # Messages stored in bfloat16; the log normalizers are still accumulated in float32
+        posterior3 = parallel.hmm_filter(initial_probs, transition_matrix, log_likelihoods, dtype=jnp.bfloat16)
+        assert jnp.allclose(posterior.marginal_loglik, posterior3.marginal_loglik, atol=1e-3 * num_timesteps)
+        assert jnp.allclose(posterior.filtered_probs, posterior3.filtered_probs, atol=2e-2)
+
+
+def test_parallel_filter_auto(key=0, num_timesteps=100, num_states=3):
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+
+    initial_probs, transition_matrix, log_likelihoods = \
+        random_hmm_args(key, num_timesteps, num_states)
+
+    posterior = core.hmm_filter(initial_probs, transition_matrix, log_likelihoods)
+    for mode in ["auto", True, False]:
+        posterior2 = parallel.hmm_filter_auto(initial_probs, transition_matrix, log_likelihoods, parallel=mode)
+        assert jnp.allclose(posterior.marginal_loglik, posterior2.marginal_loglik, atol=1e-3)
+        assert jnp.allclose(posterior.filtered_probs, posterior2.filtered_probs, atol=1e-3)
+
+
+@pytest.mark.parametrize("num_timesteps", [1, 100])
+def test_parallel_filter_block_diag(num_timesteps, key=0, num_blocks=3, block_size=2):
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+
+    num_states = num_blocks * block_size
+    initial_probs, transition_matrix, log_likelihoods = \
+        random_hmm_args(key, num_timesteps, num_states)
+    transition_matrix *= jnp.kron(jnp.eye(num_blocks), jnp.ones((block_size, block_size)))
+    transition_matrix /= transition_matrix.sum(1, keepdims=True)
+
+    posterior = core.hmm_filter(initial_probs, transition_matrix, log_likelihoods)
+    posterior2 = parallel.hmm_filter(initial_probs, transition_matrix, log_likelihoods,
+                                     structure="block_diag", block_size=block_size)
+    assert jnp.allclose(posterior.marginal_loglik, posterior2.marginal_loglik, atol=1e-3)
+    assert jnp.allclose(posterior.filtered_probs, posterior2.filtered_probs, atol=1e-3)
+    assert jnp.allclose(posterior.predicted_probs, posterior2.predicted_probs, atol=1e-3)
+
+    with pytest.raises(ValueError):
+        parallel.hmm_filter(initial_probs, transition_matrix, log_likelihoods, structure="block_diag")
+
+
+def test_parallel_filter_block_diag_off_block_mass(key=0, num_timesteps=20, num_states=4, block_size=2):
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+
+    initial_probs, transition_matrix, log_likelihoods = \
+        random_hmm_args(key, num_timesteps, num_states)
+    filter_fn = partial(parallel.hmm_filter, structure="block_diag", block_size=block_size)
+
+    # Mass outside the diagonal blocks is rejected when it can be checked...
+    with pytest.raises(ValueError):
+        filter_fn(initial_probs, transition_matrix, log_likelihoods)
+
+    # ...and dropped under jit
+    block_mask = jnp.kron(jnp.eye(num_states // block_size), jnp.ones((block_size, block_size)))
+    posterior = filter_fn(initial_probs, transition_matrix * block_mask, log_likelihoods)
+    posterior2 = jax.jit(filter_fn)(initial_probs, transition_matrix, log_likelihoods)
+    assert jnp.allclose(posterior.filtered_probs, posterior2.filtered_probs, atol=1e-5)
+
+
+def test_log_matmul(key=0, num_states=5):
+    if isinstance(key, int):
+        key = jr.PRNGKey(key)
+    k1, k2 = jr.split(key)
+    log_A = 100 * jr.normal(k1, (num_states, num_states))
+    log_B = 100 * jr.normal(k2, (num_states, num_states))
+    log_AB = logsumexp(log_A[:, :, None] + log_B[None, :, :], axis=1)
+    assert jnp.allclose(parallel._log_matmul(log_A, log_B), log_AB, atol=1e-3)
+    assert jnp.allclose(parallel._log_matmul(log_A, log_B, block_size=2), log_AB, atol=1e-3)
+
+    # Terms far below the row and column maxima must not underflow
+    log_A = jnp.array([[0., -200.], [0., -200.]])
+    log_B = jnp.array([[-200., 0.], [0., -200.]])
+    assert jnp.allclose(parallel._log_matmul(log_A, log_B)[:, 0], -200. + jnp.log(2.), atol=1e-3)
+
+
+def test_parallel_log_filter_large_gaps():
+    log_initial_probs = jnp.array([0., -jnp.inf])
+    log_transition_matrix = jnp.array([[0., -100.], [jnp.log(.5), jnp.log(.5)]])
+    log_likelihoods = jnp.array([[0., 0.], [0., 0.], [-300., 0.], [0., 0.]])
+
+    # Exact forward recursion in log space
+    log_alpha = log_initial_probs + log_likelihoods[0]
+    for ll in log_likelihoods[1:]:
+        log_alpha = logsumexp(log_alpha[:, None] + log_transition_matrix, axis=0) + ll
+    marginal_loglik = logsumexp(log_alpha)
+
+    posterior = parallel.log_hmm_filter(log_initial_probs, log_transition_matrix, log_likelihoods)
+    assert jnp.allclose(posterior.marginal_loglik, marginal_loglik, atol=1e-3)
+    assert jnp.allclose(posterior.filtered_probs[-1], jnp.exp(log_alpha - marginal_loglik), atol=1e-3)
+
+    posterior = parallel.hmm_smoother_logspace(log_initial_probs, log_transition_matrix, log_likelihoods)
+    assert jnp.all(jnp.isfinite(posterior.smoothed_probs))
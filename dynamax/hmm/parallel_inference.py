@@ -1,10 +1,13 @@
 import chex
+import jax
 import jax.numpy as jnp
 from jax import lax
 from jax import vmap
 from jax import value_and_grad
+from jax.scipy.special import logsumexp
 
 from dynamax.hmm.inference import HMMPosterior
+from dynamax.hmm.inference import hmm_filter as hmm_filter_sequential
 
 @chex.dataclass
 class Message:
@@ -20,24 +23,312 @@ def _condition_on(A, ll, axis=-1):
     return A_cond, jnp.log(norm) + ll_max
 
 
-def hmm_filter(initial_probs, transition_matrix, log_likelihoods):
-    T, K = log_likelihoods.shape
+def _log_condition_on(log_A, ll, axis=-1):
+    log_A_cond = log_A + ll
+    log_norm = logsumexp(log_A_cond, axis=axis)
+    log_A_cond -= jnp.expand_dims(log_norm, axis=axis)
+    return log_A_cond, log_norm
+
+
+# Number of contracted states processed at once in `_log_matmul`.
+_LOG_MATMUL_BLOCK_SIZE = 32
+
+
+def _safe_logsumexp(x, axis):
+    """A `logsumexp` whose gradient stays finite when every term is -inf.
+
+    Such all -inf slices arise from structural zeros in the transition matrix.
+    """
+    x_max = lax.stop_gradient(x.max(axis=axis, keepdims=True))
+    x_max = jnp.where(jnp.isfinite(x_max), x_max, 0.)
+    total = jnp.exp(x - x_max).sum(axis=axis, keepdims=True)
+    nonzero = total > 0
+    out = jnp.where(nonzero, jnp.log(jnp.where(nonzero, total, 1.)), -jnp.inf) + x_max
+    return out.squeeze(axis)
+
+
+def _log_matmul(log_A, log_B, block_size=_LOG_MATMUL_BLOCK_SIZE):
+    """Compute log(exp(log_A) @ exp(log_B)) exactly in log space.
+
+    The contraction is a `logsumexp` over the shared axis, so terms far below
+    the maxima do not underflow. To bound memory, the contracted axis is
+    processed in blocks of `block_size`, so at most a (K, block_size, K) array
+    is materialized rather than (K, K, K).
+    """
+    K = log_A.shape[-1]
+    if K <= block_size:
+        return _safe_logsumexp(log_A[:, :, None] + log_B[None, :, :], axis=1)
+
+    # Pad the contracted axis with -inf (zero probability) to a multiple of the block size
+    num_blocks = -(-K // block_size)
+    pad = num_blocks * block_size - K
+    log_A = jnp.pad(log_A, ((0, 0), (0, pad)), constant_values=-jnp.inf)
+    log_B = jnp.pad(log_B, ((0, pad), (0, 0)), constant_values=-jnp.inf)
+    A_blocks = jnp.moveaxis(log_A.reshape(log_A.shape[0], num_blocks, block_size), 1, 0)
+    B_blocks = log_B.reshape(num_blocks, block_size, log_B.shape[-1])
+
+    partial = lax.map(lambda blocks: _safe_logsumexp(blocks[0][:, :, None] + blocks[1][None, :, :], axis=1),
+                      (A_blocks, B_blocks))
+    return _safe_logsumexp(partial, axis=0)
+
+
+def _combine_fused(A_ij, log_b_ij, A_jk, log_b_jk):
+    """Condition `A_ij` on `log_b_jk` and compose it with `A_jk` in one contraction.
+
+    The row normalizer of the conditioned matrix is a matrix-vector product, so
+    it is applied to the (K, K) output instead of materializing the conditioned
+    matrix as an intermediate.
+    """
+    # The messages may be stored in a lower precision than the log normalizers
+    # (see `hmm_filter`); the arithmetic is done in the precision of the latter.
+    acc_dtype = log_b_jk.dtype
+    A_ij_acc, A_jk_acc = A_ij.astype(acc_dtype), A_jk.astype(acc_dtype)
+
+    ll_max = log_b_jk.max()
+    w = jnp.exp(log_b_jk - ll_max)
+    norm = A_ij_acc @ w
+    A_ik = jnp.einsum('ij,j,jk->ik', A_ij_acc, w, A_jk_acc) / norm[:, None]
+    log_b_ik = log_b_ij + jnp.log(norm) + ll_max
+    return Message(A=A_ik.astype(A_ij.dtype), log_b=log_b_ik)
+
+
+def _marginalize(m_ij, m_jk):
+    return _combine_fused(m_ij.A, m_ij.log_b, m_jk.A, m_jk.log_b)
+
+
+def _log_marginalize(m_ij, m_jk):
+    log_A_ij_cond, lognorm = _log_condition_on(m_ij.A, m_jk.log_b)
+    log_A_ik = _log_matmul(log_A_ij_cond, m_jk.A)
+    log_b_ik = m_ij.log_b + lognorm
+    return Message(A=log_A_ik, log_b=log_b_ik)
+
+
+@chex.dataclass
+class BackwardMessage:
+    A: chex.Array
+    log_b: chex.Array
+    log_offset: chex.Array
+
+
+def _backward_marginalize(m_ij, m_jk):
+    """Combine backward messages whose `log_b` is stored relative to its maximum.
+
+    The absolute log likelihood of a segment grows with its length, so storing
+    it per state would lose the differences between states to rounding. Each
+    message instead keeps `log_b - max(log_b)` and carries the maximum in the
+    scalar `log_offset`.
+    """
+    m_ik = _combine_fused(m_ij.A, m_ij.log_b, m_jk.A, m_jk.log_b)
+    log_b_max = m_ik.log_b.max()
+    return BackwardMessage(A=m_ik.A,
+                           log_b=m_ik.log_b - log_b_max,
+                           log_offset=m_ij.log_offset + m_jk.log_offset + log_b_max)
 
-    @vmap
-    def marginalize(m_ij, m_jk):
-        A_ij_cond, lognorm = _condition_on(m_ij.A, m_jk.log_b)
-        A_ik = A_ij_cond @ m_jk.A
-        log_b_ik = m_ij.log_b + lognorm
-        return Message(A=A_ik, log_b=log_b_ik)
 
+def _predicted_probs(initial_probs, transition_matrix, filtered_probs):
+    """Compute predicted_probs(t) = p(hid(t) | obs(1:t-1)) from the filtered probabilities.
+
+    The one-step predictions are written directly into a (T, K) buffer that
+    starts out as the initial distribution, rather than stacked onto it.
+    """
+    T, K = filtered_probs.shape
+    return lax.dynamic_update_slice(jnp.broadcast_to(initial_probs, (T, K)),
+                                    filtered_probs[:-1] @ transition_matrix, (1, 0))
+
+
+def _make_combine_fn(marginalize_fn, remat):
+    """Vectorize a message combine function for `lax.associative_scan`.
+
+    If `remat` is True, the combine is wrapped in `jax.checkpoint` so that its
+    intermediates are recomputed, rather than stored, on the backward pass.
+    """
+    combine_fn = vmap(marginalize_fn)
+    return jax.checkpoint(combine_fn) if remat else combine_fn
+
+
+def _dense_filter_messages(initial_probs, transition_matrix, log_likelihoods, remat):
+    """Run the associative scan with dense (K, K) messages.
+
+    Returns the marginal log likelihood and the filtered probabilities.
+    """
+    T, K = log_likelihoods.shape
+    marginalize = _make_combine_fn(_marginalize, remat)
 
     # Initialize the messages
     A0, log_b0 = _condition_on(initial_probs, log_likelihoods[0])
-    A0 *= jnp.ones((K, K))
-    log_b0 *= jnp.ones(K)
+    A0 = jnp.broadcast_to(A0, (K, K))
+    log_b0 = jnp.broadcast_to(log_b0, (K,))
     A1T, log_b1T = vmap(_condition_on, in_axes=(None, 0))(transition_matrix, log_likelihoods[1:])
     initial_messages = Message(
-        A=jnp.concatenate([A0[None, :, :], A1T]),
+        A=jnp.concatenate([A0[None, :, :], A1T]).astype(transition_matrix.dtype),
+        log_b=jnp.vstack([log_b0, log_b1T])
+    )
+
+    # Run the associative scan
+    partial_messages = lax.associative_scan(marginalize, initial_messages)
+
+    # Extract the marginal log likelihood and filtered probabilities
+    return partial_messages.log_b[-1,0], partial_messages.A[:, 0, :]
+
+
+def _block_diag_filter_messages(initial_probs, transition_matrix, log_likelihoods, block_size, remat):
+    """Run the associative scan with block-diagonal messages.
+
+    Conditioning and composition both preserve the zeros of a block-diagonal
+    transition matrix, so the scan only needs to carry the diagonal blocks. The
+    initial message is dense, so it is kept out of the scan and folded into
+    the prefix messages at the end.
+
+    Returns the marginal log likelihood and the filtered probabilities.
+    """
+    T, K = log_likelihoods.shape
+    if block_size is None:
+        raise ValueError("block_size must be given when structure='block_diag'")
+    if K % block_size != 0:
+        raise ValueError(f"block_size={block_size} does not divide the number of states {K}")
+    num_blocks = K // block_size
+    if not isinstance(transition_matrix, jax.core.Tracer):
+        block_mask = jnp.kron(jnp.eye(num_blocks), jnp.ones((block_size, block_size)))
+        if jnp.any(jnp.where(block_mask > 0, 0, transition_matrix) != 0):
+            raise ValueError(f"transition_matrix has nonzero entries outside the diagonal blocks "
+                             f"of size {block_size}")
+    marginalize = _make_combine_fn(vmap(_marginalize), remat)
+
+    # Condition on the first emission
+    filtered_probs0, log_b0 = _condition_on(initial_probs, log_likelihoods[0])
+    if T == 1:
+        return log_b0, filtered_probs0[None]
+
+    # Extract the (num_blocks, block_size, block_size) diagonal blocks
+    blocks = transition_matrix.reshape(num_blocks, block_size, num_blocks, block_size)
+    blocks = jnp.moveaxis(jnp.diagonal(blocks, axis1=0, axis2=2), -1, 0)
+
+    # Initialize the messages for time steps 1, ..., T-1 and run the scan
+    block_lls = log_likelihoods[1:].reshape(T - 1, num_blocks, block_size)
+    A1T, log_b1T = vmap(vmap(_condition_on))(jnp.broadcast_to(blocks, (T - 1,) + blocks.shape), block_lls)
+    partial_messages = lax.associative_scan(marginalize, Message(A=A1T.astype(blocks.dtype), log_b=log_b1T))
+
+    # Combine the first filtered distribution with each prefix message
+    def _fold_in_first(A, log_b):
+        weights, log_norm = _condition_on(filtered_probs0, log_b.reshape(K))
+        filtered_probs = jnp.einsum('bi,bij->bj', weights.reshape(num_blocks, block_size), A)
+        return filtered_probs.reshape(K), log_b0 + log_norm
+
+    filtered_probs1T, log_normalizers = vmap(_fold_in_first)(partial_messages.A, partial_messages.log_b)
+    filtered_probs = jnp.vstack([filtered_probs0, filtered_probs1T])
+    return log_normalizers[-1], filtered_probs
+
+
+def hmm_filter(initial_probs, transition_matrix, log_likelihoods, remat=False, dtype=None,
+               structure="dense", block_size=None):
+    """A parallel implementation of the forward filter.
+
+    Args:
+        initial_probs(k): prob(hid(1)=k)
+        transition_matrix(j,k): prob(hid(t)=k | hid(t-1)=j)
+        log_likelihoods(t,k): log p(obs(t) | hid(t)=k)
+        remat(bool): recompute the scan combines on the backward pass instead
+            of storing their intermediates (only matters under differentiation).
+        dtype: if given, store the scan messages in this precision (e.g.
+            `jnp.float32` when x64 is enabled, or `jnp.bfloat16`) and cast the
+            outputs back to the dtype of `log_likelihoods`. The log likelihoods
+            and log normalizers, and the arithmetic of each combine, use at
+            least float32.
+        structure(str): either "dense" or "block_diag". With "block_diag", the
+            transition matrix is assumed to be block diagonal with contiguous
+            blocks of size `block_size`, and the scan works on the blocks only,
+            reducing the cost of each combine from O(K^3) to O(K * block_size^2).
+            A ValueError is raised if the transition matrix has mass outside
+            the blocks. Under `jit` this cannot be checked, and such mass is
+            silently dropped.
+        block_size(int): size of the diagonal blocks when structure="block_diag".
+
+    Returns: HMMPosterior object (smoothed_probs=None)
+    """
+    out_dtype = log_likelihoods.dtype
+    scan_args = (initial_probs, transition_matrix, log_likelihoods)
+    if dtype is not None:
+        scan_args = (initial_probs.astype(dtype),
+                     transition_matrix.astype(dtype),
+                     log_likelihoods.astype(jnp.promote_types(dtype, jnp.float32)))
+
+    if structure == "dense":
+        marginal_loglik, filtered_probs = _dense_filter_messages(*scan_args, remat)
+    elif structure == "block_diag":
+        marginal_loglik, filtered_probs = _block_diag_filter_messages(*scan_args, block_size, remat)
+    else:
+        raise ValueError(f"Unknown transition matrix structure: {structure}")
+    marginal_loglik = marginal_loglik.astype(out_dtype)
+    filtered_probs = filtered_probs.astype(out_dtype)
+
+    # Compute the predicted probabilities
+    predicted_probs = _predicted_probs(initial_probs.astype(out_dtype),
+                                       transition_matrix.astype(out_dtype),
+                                       filtered_probs)
+
+    # Package into a posterior object
+    return HMMPosterior(marginal_loglik=marginal_loglik,
+                        filtered_probs=filtered_probs,
+                        predicted_probs=predicted_probs)
+
+
+def hmm_filter_auto(initial_probs, transition_matrix, log_likelihoods, parallel="auto",
+                    min_parallel_timesteps=1000):
+    """Run either the sequential or the parallel HMM filter.
+
+    The associative scan carries a (K, K) matrix per time step and does
+    O(K^3) work per combine, compared to O(K^2) per step for the sequential
+    `lax.scan` recursion. It only pays off when there is enough hardware
+    parallelism and the sequence is long.
+
+    Args:
+        initial_probs(k): prob(hid(1)=k)
+        transition_matrix(j,k): prob(hid(t)=k | hid(t-1)=j)
+        log_likelihoods(t,k): log p(obs(t) | hid(t)=k)
+        parallel: True, False, or "auto". In "auto" mode, the parallel filter
+            is used on accelerators for sequences of at least
+            `min_parallel_timesteps` steps, and the sequential one otherwise.
+        min_parallel_timesteps(int): threshold used in "auto" mode.
+
+    Returns: HMMPosterior object (smoothed_probs=None)
+    """
+    if parallel == "auto":
+        num_timesteps = log_likelihoods.shape[0]
+        parallel = jax.default_backend() != "cpu" and num_timesteps >= min_parallel_timesteps
+
+    if parallel:
+        return hmm_filter(initial_probs, transition_matrix, log_likelihoods)
+    else:
+        return hmm_filter_sequential(initial_probs, transition_matrix, log_likelihoods)
+
+
+def log_hmm_filter(log_initial_probs, log_transition_matrix, log_likelihoods, remat=False):
+    """A parallel HMM filter that keeps the messages in log space.
+
+    Unlike `hmm_filter`, the conditional transition matrices `Message.A` are
+    stored as log probabilities and combined in log space, so no `exp`/`log`
+    round-trip is needed when the inputs are already log probabilities. This
+    makes it a cheaper (and more stable) target for automatic differentiation.
+
+    Args:
+        log_initial_probs(k): log prob(hid(1)=k)
+        log_transition_matrix(j,k): log prob(hid(t)=k | hid(t-1)=j)
+        log_likelihoods(t,k): log p(obs(t) | hid(t)=k)
+        remat(bool): recompute the scan combines on the backward pass instead
+            of storing their intermediates (only matters under differentiation).
+
+    Returns: HMMPosterior object (smoothed_probs=None)
+    """
+    T, K = log_likelihoods.shape
+    marginalize = _make_combine_fn(_log_marginalize, remat)
+
+    # Initialize the messages
+    log_A0, log_b0 = _log_condition_on(log_initial_probs, log_likelihoods[0])
+    log_A0 = jnp.broadcast_to(log_A0, (K, K))
+    log_b0 = jnp.broadcast_to(log_b0, (K,))
+    log_A1T, log_b1T = vmap(_log_condition_on, in_axes=(None, 0))(log_transition_matrix, log_likelihoods[1:])
+    initial_messages = Message(
+        A=jnp.concatenate([log_A0[None, :, :], log_A1T]),
         log_b=jnp.vstack([log_b0, log_b1T])
     )
 
@@ -46,10 +337,10 @@ def hmm_filter(initial_probs, transition_matrix, log_likelihoods):
 
     # Extract the marginal log likelihood and filtered probabilities
     marginal_loglik = partial_messages.log_b[-1,0]
-    filtered_probs = partial_messages.A[:, 0, :]
+    filtered_probs = jnp.exp(partial_messages.A[:, 0, :])
 
     # Compute the predicted probabilities
-    predicted_probs = jnp.vstack([initial_probs, filtered_probs[:-1] @ transition_matrix])
+    predicted_probs = _predicted_probs(jnp.exp(log_initial_probs), jnp.exp(log_transition_matrix), filtered_probs)
 
     # Package into a posterior object
     return HMMPosterior(marginal_loglik=marginal_loglik,
@@ -57,25 +348,127 @@ def hmm_filter(initial_probs, transition_matrix, log_likelihoods):
                         predicted_probs=predicted_probs)
 
 
-def hmm_smoother(initial_probs, transition_matrix, log_likelihoods):
+def hmm_backward_filter(transition_matrix, log_likelihoods, remat=False):
+    """A parallel implementation of the backward filter.
+
+    The backward messages are built from the same conditional transition
+    matrices as in `hmm_filter` and combined with a reversed associative scan,
+    so that the t-th result holds log p(obs(t+1:T) | hid(t)).
+
+    Args:
+        transition_matrix(j,k): prob(hid(t)=k | hid(t-1)=j)
+        log_likelihoods(t,k): log p(obs(t) | hid(t)=k)
+        remat(bool): recompute the scan combines on the backward pass instead
+            of storing their intermediates (only matters under differentiation).
+
+    Returns:
+        log_normalizer
+        backward_pred_probs(t,k) proportional to p(obs(t+1:T) | hid(t)=k)
+    """
+    T, K = log_likelihoods.shape
+    marginalize = _make_combine_fn(_backward_marginalize, remat)
+
+    # Initialize the messages. The last message is a final step with a flat
+    # likelihood, so it leaves log_b unchanged; only log_b of the scan output is
+    # meaningful (the A matrices it produces are uniform).
+    A0T1, log_b0T1 = vmap(_condition_on, in_axes=(None, 0))(transition_matrix, log_likelihoods[1:])
+    log_b0T1 = jnp.vstack([log_b0T1, jnp.zeros(K)])
+    log_offset = log_b0T1.max(axis=1)
+    initial_messages = BackwardMessage(
+        A=jnp.concatenate([A0T1, jnp.ones((1, K, K)) / K]),
+        log_b=log_b0T1 - log_offset[:, None],
+        log_offset=log_offset
+    )
+
+    # Run the associative scan in reverse. The first argument to the combine
+    # is the (later) accumulated message and the second is the earlier one.
+    partial_messages = lax.associative_scan(lambda m_jk, m_ij: marginalize(m_ij, m_jk),
+                                            initial_messages, reverse=True)
+
+    # Normalize the backward messages
+    log_betas = partial_messages.log_b
+    log_normalizer = logsumexp(log_likelihoods[0] + log_betas[0]) + partial_messages.log_offset[0]
+    backward_pred_probs = jnp.exp(log_betas - logsumexp(log_betas, axis=1, keepdims=True))
+    return log_normalizer, backward_pred_probs
+
+
+def hmm_smoother(initial_probs, transition_matrix, log_likelihoods, remat=True, method="two_filter"):
     """A parallel implementation of `hmm_smoother`.
-    NOTE: This implementation uses the gradient of the HMM log normalizer
-    rather than an explicit implementation of the backward message passing.
+
+    By default, the smoothed probabilities are obtained by combining the
+    outputs of the parallel forward filter and the parallel backward filter.
+    With `method="autodiff"`, they are instead obtained from the gradient of
+    the HMM log normalizer, which is simpler but stores the whole scan for
+    the backward pass.
 
     Args:
         initial_probs (_type_): _description_
         transition_matrix (_type_): _description_
         log_likelihoods (_type_): _description_
+        remat (bool): checkpoint the scan combines so that the backward pass
+            recomputes them rather than storing every intermediate message.
+        method (str): either "two_filter" or "autodiff".
+    """
+    if method == "two_filter":
+        return _two_filter_smoother(initial_probs, transition_matrix, log_likelihoods, remat)
+    elif method == "autodiff":
+        return hmm_smoother_logspace(jnp.log(initial_probs), jnp.log(transition_matrix), log_likelihoods, remat)
+    else:
+        raise ValueError(f"Unknown smoothing method: {method}")
+
+
+def _two_filter_smoother(initial_probs, transition_matrix, log_likelihoods, remat):
+    post = hmm_filter(initial_probs, transition_matrix, log_likelihoods, remat=remat)
+    filtered_probs, predicted_probs = post.filtered_probs, post.predicted_probs
+    _, backward_pred_probs = hmm_backward_filter(transition_matrix, log_likelihoods, remat=remat)
+
+    # Compute smoothed probabilities
+    smoothed_probs = filtered_probs * backward_pred_probs
+    smoothed_probs /= smoothed_probs.sum(axis=1, keepdims=True)
+
+    # Compute the expected transition counts,
+    #   sum_t p(hid(t)=i, hid(t+1)=j | obs(1:T)) \propto
+    #   sum_t filtered_probs(t,i) A(i,j) p(obs(t+1) | hid(t+1)=j) backward_pred_probs(t+1,j)
+    ll = log_likelihoods[1:]
+    weights = jnp.exp(ll - ll.max(axis=1, keepdims=True)) * backward_pred_probs[1:]
+    norm = (predicted_probs[1:] * weights).sum(axis=1)
+    trans_probs = transition_matrix * ((filtered_probs[:-1] / norm[:, None]).T @ weights)
+
+    return HMMPosterior(
+        marginal_loglik=post.marginal_loglik,
+        filtered_probs=filtered_probs,
+        predicted_probs=predicted_probs,
+        initial_probs=smoothed_probs[0],
+        smoothed_probs=smoothed_probs,
+        trans_probs=trans_probs
+    )
+
+
+def hmm_smoother_logspace(log_initial_probs, log_transition_matrix, log_likelihoods, remat=True):
+    """A parallel smoother for HMMs whose parameters are given in log space.
+
+    The smoothed probabilities are the gradient of the log normalizer computed
+    by `log_hmm_filter`. Callers that already hold log parameters should use
+    this function rather than `hmm_smoother(..., method="autodiff")`, which
+    takes the log of its inputs first.
+
+    Args:
+        log_initial_probs(k): log prob(hid(1)=k)
+        log_transition_matrix(j,k): log prob(hid(t)=k | hid(t-1)=j)
+        log_likelihoods(t,k): log p(obs(t) | hid(t)=k)
+        remat(bool): checkpoint the scan combines so that the backward pass
+            recomputes them rather than storing every intermediate message.
+
+    Returns:
+        HMMPosterior object
     """
     def log_normalizer(log_initial_probs, log_transition_matrix, log_likelihoods):
-        post = hmm_filter(jnp.exp(log_initial_probs),
-                                   jnp.exp(log_transition_matrix),
-                                   log_likelihoods)
+        post = log_hmm_filter(log_initial_probs, log_transition_matrix, log_likelihoods, remat=remat)
         return post.marginal_loglik, post
 
     f = value_and_grad(log_normalizer, has_aux=True, argnums=(1, 2))
     (marginal_loglik, fwd_post), (trans_probs, smoothed_probs) = \
-        f(jnp.log(initial_probs), jnp.log(transition_matrix), log_likelihoods)
+        f(log_initial_probs, log_transition_matrix, log_likelihoods)
 
     return HMMPosterior(
         marginal_loglik=marginal_loglik,
@@ -84,4 +477,4 @@ def hmm_smoother(initial_probs, transition_matrix, log_likelihoods):
         initial_probs=smoothed_probs[0],
         smoothed_probs=smoothed_probs,
         trans_probs=trans_probs
-    )
\ No newline at end of file
+    )
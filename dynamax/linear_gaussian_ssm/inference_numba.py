@@ -0,0 +1,118 @@
+# Sequential Kalman filtering with numba for models with a small latent state.
+# For tiny state dimensions the per-step overhead of XLA dominates the cost of
+# the filter, and a compiled loop over NumPy arrays is considerably faster on CPU.
+# numba is an optional dependency; without it, we fall back to the JAX filter.
+import numpy as np
+from jax import numpy as jnp
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from dynamax.containers import GSSMPosterior
+from dynamax.linear_gaussian_ssm.inference import lgssm_filter as serial_lgssm_filter
+
+# Models with at least this many latent dimensions use the JAX filter.
+MAX_NUMBA_STATE_DIM = 8
+
+
+def _kalman_filter(initial_mean, initial_covariance, F, b, Q, H, d, R, emissions):
+    """Sequential Kalman filter on float64 NumPy arrays.
+
+    Returns:
+        marginal_loglik
+        filtered_means (T, D_hid)
+        filtered_covariances (T, D_hid, D_hid)
+    """
+    num_timesteps, emission_dim = emissions.shape
+    state_dim = initial_mean.shape[0]
+    filtered_means = np.empty((num_timesteps, state_dim))
+    filtered_covs = np.empty((num_timesteps, state_dim, state_dim))
+
+    ll = 0.0
+    pred_mean = initial_mean.copy()
+    pred_cov = initial_covariance.copy()
+    for t in range(num_timesteps):
+        # Condition on this emission
+        HP = H @ pred_cov
+        S = HP @ H.T + R
+        resid = emissions[t] - H @ pred_mean - d
+        K = np.ascontiguousarray(np.linalg.solve(S, HP).T)
+        filtered_mean = pred_mean + K @ resid
+        filtered_cov = pred_cov - K @ HP
+
+        # Update the log likelihood
+        L = np.linalg.cholesky(S)
+        z = np.linalg.solve(L, resid)
+        ll += -0.5 * (z @ z) - np.sum(np.log(np.diag(L))) - 0.5 * emission_dim * np.log(2 * np.pi)
+
+        filtered_means[t] = filtered_mean
+        filtered_covs[t] = filtered_cov
+
+        # Predict the next state
+        pred_mean = F @ filtered_mean + b
+        pred_cov = F @ filtered_cov @ F.T + Q
+
+    return ll, filtered_means, filtered_covs
+
+
+if numba is not None:
+    _kalman_filter = numba.njit(cache=True, fastmath=True)(_kalman_filter)
+
+
+def _numba_supported(params, inputs):
+    """Check whether the numba loop handles this model.
+
+    The loop covers time-invariant models with optional biases. Inputs and
+    time-varying parameters are left to the JAX filter.
+    """
+    if numba is None or inputs is not None:
+        return False
+    if params.dynamics_input_weights is not None or params.emission_input_weights is not None:
+        return False
+    if params.dynamics_matrix.shape[0] >= MAX_NUMBA_STATE_DIM:
+        return False
+    matrices = (params.dynamics_matrix, params.dynamics_covariance,
+                params.emission_matrix, params.emission_covariance)
+    biases = (params.dynamics_bias, params.emission_bias)
+    return all(x.ndim == 2 for x in matrices) and all(x is None or x.ndim == 1 for x in biases)
+
+
+def lgssm_filter(params, emissions, inputs=None):
+    """Run a Kalman filter, using numba for models with a small state dimension.
+
+    If numba is installed, the state dimension is less than
+    `MAX_NUMBA_STATE_DIM`, and the model is time-invariant without inputs, the
+    filter runs as a compiled sequential loop on the CPU. Otherwise it defers
+    to the sequential JAX implementation in
+    `dynamax.linear_gaussian_ssm.inference`. Both paths return the marginal
+    log likelihood along with the filtered moments.
+
+    Note: the numba path converts its arguments to NumPy arrays, so it cannot be
+    called inside `jax.jit` or other transformations.
+
+    Args:
+        params: an LGSSMParams instance.
+        emissions: (T, D_obs) array of observations.
+        inputs: (T, D_in) array of inputs.
+
+    Returns:
+        GSSMPosterior instance with the marginal log likelihood and the
+        filtered means and covariances.
+    """
+    if not _numba_supported(params, inputs):
+        return serial_lgssm_filter(params, emissions, inputs)
+
+    state_dim = params.dynamics_matrix.shape[0]
+    emission_dim = params.emission_matrix.shape[0]
+    dynamics_bias = np.zeros(state_dim) if params.dynamics_bias is None else params.dynamics_bias
+    emission_bias = np.zeros(emission_dim) if params.emission_bias is None else params.emission_bias
+    args = (params.initial_mean, params.initial_covariance,
+            params.dynamics_matrix, dynamics_bias, params.dynamics_covariance,
+            params.emission_matrix, emission_bias, params.emission_covariance,
+            emissions)
+    ll, filtered_means, filtered_covs = _kalman_filter(*(np.asarray(x, dtype=np.float64) for x in args))
+    return GSSMPosterior(marginal_loglik=jnp.asarray(ll),
+                         filtered_means=jnp.asarray(filtered_means),
+                         filtered_covariances=jnp.asarray(filtered_covs))
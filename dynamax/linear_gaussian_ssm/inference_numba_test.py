@@ -0,0 +1,61 @@
+import pytest
+from jax import numpy as jnp
+from jax import random as jr
+
+import dynamax.linear_gaussian_ssm.inference_numba as inference_numba
+from dynamax.linear_gaussian_ssm.inference import LGSSMParams
+from dynamax.linear_gaussian_ssm.inference import lgssm_filter as serial_lgssm_filter
+
+
+def random_lgssm_args(key, num_timesteps, latent_dim, observation_dim=2):
+    k1, k2 = jr.split(key)
+    lgssm_params = LGSSMParams(
+        initial_mean = jnp.zeros(latent_dim),
+        initial_covariance = jnp.eye(latent_dim),
+        dynamics_matrix = 0.9 * jnp.eye(latent_dim) + 0.1 * jnp.eye(latent_dim, k=1),
+        dynamics_covariance = 0.1 * jnp.eye(latent_dim),
+        emission_matrix = jr.normal(k1, (observation_dim, latent_dim)),
+        emission_covariance = 0.5 ** 2 * jnp.eye(observation_dim)
+    )
+    emissions = jr.normal(k2, (num_timesteps, observation_dim))
+    return lgssm_params, emissions
+
+
+def check_filter(lgssm_params, emissions):
+    serial_posterior = serial_lgssm_filter(lgssm_params, emissions)
+    numba_posterior = inference_numba.lgssm_filter(lgssm_params, emissions)
+    assert jnp.allclose(serial_posterior.marginal_loglik, numba_posterior.marginal_loglik, rtol=1e-3)
+    assert jnp.allclose(serial_posterior.filtered_means, numba_posterior.filtered_means, atol=1e-4, rtol=1e-3)
+    assert jnp.allclose(serial_posterior.filtered_covariances, numba_posterior.filtered_covariances,
+                        atol=1e-5, rtol=1e-3)
+
+
+def test_numba_filter(num_timesteps=50, latent_dim=4):
+    """ Compare numba and serial lgssm filtering implementations."""
+    pytest.importorskip("numba")
+    check_filter(*random_lgssm_args(jr.PRNGKey(0), num_timesteps, latent_dim))
+
+
+@pytest.mark.parametrize("latent_dim", [4, inference_numba.MAX_NUMBA_STATE_DIM])
+def test_fallback_filter(monkeypatch, latent_dim, num_timesteps=50):
+    """ The JAX fallback (no numba, or a large state) returns the same posterior."""
+    if latent_dim < inference_numba.MAX_NUMBA_STATE_DIM:
+        monkeypatch.setattr(inference_numba, "numba", None)
+    check_filter(*random_lgssm_args(jr.PRNGKey(0), num_timesteps, latent_dim))
+
+
+def test_numba_filter_biases(num_timesteps=50, latent_dim=4):
+    """ Both paths apply the dynamics and emission biases."""
+    lgssm_params, emissions = random_lgssm_args(jr.PRNGKey(0), num_timesteps, latent_dim)
+    lgssm_params = lgssm_params.replace(dynamics_bias=jnp.ones(latent_dim),
+                                        emission_bias=jnp.ones(emissions.shape[1]))
+    check_filter(lgssm_params, emissions)
+
+
+def test_numba_filter_time_varying(num_timesteps=50, latent_dim=4):
+    """ Time-varying parameters are routed to the JAX filter."""
+    lgssm_params, emissions = random_lgssm_args(jr.PRNGKey(0), num_timesteps, latent_dim)
+    scales = jnp.linspace(0.5, 1.0, num_timesteps)[:, None, None]
+    lgssm_params = lgssm_params.replace(dynamics_matrix=scales * lgssm_params.dynamics_matrix)
+    assert not inference_numba._numba_supported(lgssm_params, None)
+    check_filter(lgssm_params, emissions)
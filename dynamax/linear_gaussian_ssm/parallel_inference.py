@@ -1,92 +1,127 @@
 # Parallel filtering and smoothing for a lgssm.
 # This implementation is adapted from the work of Adrien Correnflos in,
 #  https://github.com/EEA-sensors/sequential-parallelization-examples/
+import jax
 from jax import numpy as jnp
 from jax import scipy as jsc
-from jax import vmap, lax
+from jax import jit, pmap, vmap, lax
 
 from dynamax.containers import GSSMPosterior
 
 def make_associative_filtering_elements(params, emissions):
     """Preprocess observations to construct input for filtering assocative scan."""
+    F = params.dynamics_matrix
+    H = params.emission_matrix
+    Q = params.dynamics_covariance
+    R = params.emission_covariance
+    num_timesteps = emissions.shape[0]
+
+    # The quantities below do not depend on the emissions,
+    # so we factorize S and form the gains only once.
+    HQ = H @ Q
+    S = HQ @ H.T + R
+    # Solve for K^T = S^{-1} H Q and W^T = S^{-1} H F with one stacked right-hand side.
+    HF = H @ F
+    CF, low = jsc.linalg.cho_factor(S)
+    sol = jsc.linalg.cho_solve((CF, low), jnp.concatenate([HQ, HF], axis=1))
+    K = sol[:, :Q.shape[0]].T
+    W = sol[:, Q.shape[0]:].T  # F^T H^T S^{-1}
+    A = F - K @ HF
+    C = Q - K @ HQ
+    J = W @ HF
 
     def _first_filtering_element(params, y):
-        F = params.dynamics_matrix
-        H = params.emission_matrix
-        Q = params.dynamics_covariance
-        R = params.emission_covariance
-        
-        S = H @ Q @ H.T + R
-        CF, low = jsc.linalg.cho_factor(S)
-
         m1 = params.initial_mean
         P1 = params.initial_covariance
-        S1 = H @ P1 @ H.T + R
-        K1 = jsc.linalg.solve(S1, H @ P1, assume_a='pos').T
+        HP1 = H @ P1
+        S1 = HP1 @ H.T + R
+        K1 = jsc.linalg.cho_solve(jsc.linalg.cho_factor(S1), HP1).T
 
-        A = jnp.zeros_like(F)
-        b = m1 + K1 @ (y - H @ m1)
-        C = P1 - K1 @ S1 @ K1.T
+        A1 = jnp.zeros_like(F)
+        b1 = m1 + K1 @ (y - H @ m1)
+        C1 = P1 - K1 @ HP1  # K1 S1 K1^T = K1 H P1
+        return A1, b1, C1
 
-        eta = F.T @ H.T @ jsc.linalg.cho_solve((CF, low), y)
-        J = F.T @ H.T @ jsc.linalg.cho_solve((CF, low), H @ F)
-        return A, b, C, J, eta
 
-
-    def _generic_filtering_element(params, y):
-        F = params.dynamics_matrix
-        H = params.emission_matrix
-        Q = params.dynamics_covariance
-        R = params.emission_covariance
-        
-        S = H @ Q @ H.T + R
-        CF, low = jsc.linalg.cho_factor(S)  
-        K = jsc.linalg.cho_solve((CF, low), H @ Q).T  
-        A = F - K @ H @ F
+    def _generic_filtering_element(y):
         b = K @ y
-        C = Q - K @ H @ Q
+        eta = W @ y
+        return b, eta
+
+    # Build every element in its final (T, ...) shape and then overwrite the
+    # first one in place, rather than concatenating separately built arrays.
+    # The first element shares J and eta with the generic ones.
+    A1, b1, C1 = _first_filtering_element(params, emissions[0])
+    bs, etas = vmap(_generic_filtering_element)(emissions)
+    As, Cs, Js = (jnp.broadcast_to(X, (num_timesteps,) + X.shape) for X in (A, C, J))
+    combined_elems = (As.at[0].set(A1), bs.at[0].set(b1), Cs.at[0].set(C1), Js, etas)
+    return combined_elems
 
-        eta = F.T @ H.T @ jsc.linalg.cho_solve((CF, low), y)
-        J = F.T @ H.T @ jsc.linalg.cho_solve((CF, low), H @ F)
-        return A, b, C, J, eta
+def _filtering_operator(elem1, elem2):
+    """Associative operator for combining two filtering elements."""
+    A1, b1, C1, J1, eta1 = elem1
+    A2, b2, C2, J2, eta2 = elem2
+    dim = A1.shape[0]
+    I = jnp.eye(dim)
 
-    first_elems = _first_filtering_element(params, emissions[0])
-    generic_elems = vmap(_generic_filtering_element, (None, 0))(params, emissions[1:])
-    combined_elems = tuple(jnp.concatenate((first_elm[None,...], gen_elm))
-                           for first_elm, gen_elm in zip(first_elems, generic_elems))
-    return combined_elems
+    # C1 and J2 are symmetric, so I + J2 @ C1 is the transpose of I + C1 @ J2
+    # and a single LU factorization serves both solves below.
+    I_C1J2 = I + C1 @ J2
+    lu_and_piv = jsc.linalg.lu_factor(I_C1J2)
+
+    temp = jsc.linalg.lu_solve(lu_and_piv, A2.T, trans=1).T
+    A = temp @ A1
+    b = temp @ (b1 + C1 @ eta2) + b2
+    C = temp @ C1 @ A2.T + C2
+
+    temp = jsc.linalg.lu_solve(lu_and_piv, A1).T
+
+    eta = temp @ (eta2 - J2 @ b1) + eta1
+    J = temp @ J2 @ A1 + J1
+
+    return A, b, C, J, eta
+
+
+def _smoothing_operator(elem1, elem2):
+    """Associative operator for combining two smoothing elements."""
+    E1, g1, L1 = elem1
+    E2, g2, L2 = elem2
+
+    E = E2 @ E1
+    g = E2 @ g1 + g2
+    L = E2 @ L1 @ E2.T + L2
+
+    return E, g, L
 
-def lgssm_filter(params, emissions):
+
+def _make_scan_operator(operator, remat):
+    """Vectorize an associative operator for `lax.associative_scan`.
+
+    If `remat` is True, the operator is wrapped in `jax.checkpoint` so that its
+    intermediates are recomputed, rather than stored, on the backward pass.
+    """
+    scan_operator = vmap(operator)
+    return jax.checkpoint(scan_operator) if remat else scan_operator
+
+
+def lgssm_filter(params, emissions, remat=False):
     """A parallel version of the lgssm filtering algorithm.
 
     See S. Särkkä and Á. F. García-Fernández (2021) - https://arxiv.org/abs/1905.13002.
-    
+
     Note: This function does not yet handle `inputs` to the system.
+
+    Args:
+        params: an LGSSMParams instance.
+        emissions: (T, D_obs) array of observations.
+        remat: if True, checkpoint the scan operator so that differentiating
+            through the filter recomputes intermediate elements instead of
+            storing them.
     """
     #TODO: Add marginal loglikelihood calculation.
     #TODO: Add input handling.
     initial_elements = make_associative_filtering_elements(params, emissions)
-
-    @vmap
-    def filtering_operator(elem1, elem2):
-        A1, b1, C1, J1, eta1 = elem1
-        A2, b2, C2, J2, eta2 = elem2
-        dim = A1.shape[0]
-        I = jnp.eye(dim)  
-
-        I_C1J2 = I + C1 @ J2
-        temp = jsc.linalg.solve(I_C1J2.T, A2.T).T
-        A = temp @ A1
-        b = temp @ (b1 + C1 @ eta2) + b2
-        C = temp @ C1 @ A2.T + C2
-
-        I_J2C1 = I + J2 @ C1
-        temp = jsc.linalg.solve(I_J2C1.T, A1).T
-
-        eta = temp @ (eta2 - J2 @ b1) + eta1
-        J = temp @ J2 @ A1 + J1
-
-        return A, b, C, J, eta
+    filtering_operator = _make_scan_operator(_filtering_operator, remat)
 
     _, filtered_means, filtered_covs, *_ = lax.associative_scan(
                                                 filtering_operator, initial_elements
@@ -107,44 +142,42 @@ def make_associative_smoothing_elements(params, filtered_means, filtered_covaria
         Q = params.dynamics_covariance
         R = params.emission_covariance
 
-        Pp = F @ P @ F.T + Q
+        FP = F @ P
+        Pp = FP @ F.T + Q
 
-        E  = jsc.linalg.solve(Pp, F @ P, assume_a='pos').T
+        E  = jsc.linalg.cho_solve(jsc.linalg.cho_factor(Pp), FP).T
         g  = m - E @ F @ m
-        L  = P - E @ Pp @ E.T
+        L  = P - E @ FP  # E Pp E^T = E F P
         return E, g, L
 
+    # As above, build the elements in their final shape and overwrite the last one.
     last_elems = _last_smoothing_element(filtered_means[-1], filtered_covariances[-1])
     generic_elems = vmap(_generic_smoothing_element, (None, 0, 0))(
-        params, filtered_means[:-1], filtered_covariances[:-1]
+        params, filtered_means, filtered_covariances
         )
-    combined_elems = tuple(jnp.append(gen_elm, last_elm[None,:], axis=0)
+    combined_elems = tuple(gen_elm.at[-1].set(last_elm)
                            for gen_elm, last_elm in zip(generic_elems, last_elems))
     return combined_elems
 
 
-def lgssm_smoother(params, emissions):
+def lgssm_smoother(params, emissions, remat=True):
     """A parallel version of the lgssm smoothing algorithm.
 
     See S. Särkkä and Á. F. García-Fernández (2021) - https://arxiv.org/abs/1905.13002.
 
     Note: This function does not yet handle `inputs` to the system.
+
+    Args:
+        params: an LGSSMParams instance.
+        emissions: (T, D_obs) array of observations.
+        remat: if True, checkpoint the filtering and smoothing scan operators
+            to reduce peak memory when differentiating through the smoother.
     """
-    filtered_posterior = lgssm_filter(params, emissions)
+    filtered_posterior = lgssm_filter(params, emissions, remat=remat)
     filtered_means = filtered_posterior.filtered_means
     filtered_covs = filtered_posterior.filtered_covariances
     initial_elements = make_associative_smoothing_elements(params, filtered_means, filtered_covs)
-
-    @vmap
-    def smoothing_operator(elem1, elem2):
-        E1, g1, L1 = elem1
-        E2, g2, L2 = elem2
-
-        E = E2 @ E1
-        g = E2 @ g1 + g2
-        L = E2 @ L1 @ E2.T + L2
-
-        return E, g, L
+    smoothing_operator = _make_scan_operator(_smoothing_operator, remat)
 
     _, smoothed_means, smoothed_covs, *_ = lax.associative_scan(
                                                 smoothing_operator, initial_elements, reverse=True
@@ -155,3 +188,20 @@ def lgssm_smoother(params, emissions):
         smoothed_means=smoothed_means,
         smoothed_covariances=smoothed_covs
     )
+
+
+# Batched versions for many independent sequences that share parameters.
+# Vectorizing over the leading (sequence) axis of the emissions lets XLA run the
+# small per-sequence matrix operations as batched ones.
+lgssm_filter_batched = jit(vmap(lgssm_filter, in_axes=(None, 0)))
+lgssm_smoother_batched = jit(vmap(lgssm_smoother, in_axes=(None, 0)))
+
+# Versions that shard independent sequences across devices. The emissions have
+# shape (num_devices, sequences_per_device, T, D_obs); each device runs the
+# batched filter/smoother on its own slice. If the number of sequences is not a
+# multiple of the number of devices, pad the batch (e.g. by repeating a sequence)
+# and drop the extra outputs. Sequences of different lengths can be padded at
+# the end of time to a common T: this leaves the filtered estimates of the real
+# time steps unchanged, but not the smoothed ones.
+lgssm_filter_pmap = pmap(vmap(lgssm_filter, in_axes=(None, 0)), in_axes=(None, 0))
+lgssm_smoother_pmap = pmap(vmap(lgssm_smoother, in_axes=(None, 0)), in_axes=(None, 0))
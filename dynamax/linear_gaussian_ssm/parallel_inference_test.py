@@ -1,9 +1,15 @@
+import jax
 from jax import numpy as jnp
 from jax import random as jr
 
 from dynamax.linear_gaussian_ssm.inference import lgssm_sample, LGSSMParams
 from dynamax.linear_gaussian_ssm.inference import lgssm_smoother as serial_lgssm_smoother
+from dynamax.linear_gaussian_ssm.parallel_inference import lgssm_filter as parallel_lgssm_filter
+from dynamax.linear_gaussian_ssm.parallel_inference import lgssm_filter_batched as parallel_lgssm_filter_batched
+from dynamax.linear_gaussian_ssm.parallel_inference import lgssm_filter_pmap as parallel_lgssm_filter_pmap
 from dynamax.linear_gaussian_ssm.parallel_inference import lgssm_smoother as parallel_lgssm_smoother
+from dynamax.linear_gaussian_ssm.parallel_inference import lgssm_smoother_batched as parallel_lgssm_smoother_batched
+from dynamax.linear_gaussian_ssm.parallel_inference import lgssm_smoother_pmap as parallel_lgssm_smoother_pmap
 
 
 class TestParallelLGSSMSmoother:
@@ -70,4 +76,46 @@ class TestParallelLGSSMSmoother:
         assert jnp.allclose(
                 self.serial_posterior.smoothed_covariances, self.parallel_posterior.smoothed_covariances,
                 atol=1e-5,rtol=1e-3
-                )
\ No newline at end of file
+                )
+
+    def test_remat_gradients(self):
+        def loss(dynamics_matrix, emissions, remat):
+            params = self.lgssm_params.replace(dynamics_matrix=dynamics_matrix)
+            posterior = parallel_lgssm_smoother(params, emissions, remat=remat)
+            return posterior.smoothed_means.sum() + posterior.smoothed_covariances.sum()
+
+        grad_fn = jax.grad(loss, argnums=(0, 1))
+        grads = grad_fn(self.F, self.emissions, remat=False)
+        grads_remat = grad_fn(self.F, self.emissions, remat=True)
+        for g, g_remat in zip(grads, grads_remat):
+            assert jnp.allclose(g, g_remat, atol=1e-5, rtol=1e-4)
+
+    def test_batched_smoother(self):
+        batch_emissions = jnp.stack([self.emissions, 2 * self.emissions])
+        batch_posterior = parallel_lgssm_smoother_batched(self.lgssm_params, batch_emissions)
+        batch_filtered_posterior = parallel_lgssm_filter_batched(self.lgssm_params, batch_emissions)
+        for i, emissions in enumerate(batch_emissions):
+            posterior = parallel_lgssm_smoother(self.lgssm_params, emissions)
+            assert jnp.allclose(posterior.smoothed_means, batch_posterior.smoothed_means[i], rtol=1e-3)
+            assert jnp.allclose(posterior.smoothed_covariances, batch_posterior.smoothed_covariances[i],
+                                atol=1e-5, rtol=1e-3)
+            filtered_posterior = parallel_lgssm_filter(self.lgssm_params, emissions)
+            assert jnp.allclose(filtered_posterior.filtered_means, batch_filtered_posterior.filtered_means[i],
+                                rtol=1e-3)
+            assert jnp.allclose(filtered_posterior.filtered_covariances,
+                                batch_filtered_posterior.filtered_covariances[i], atol=1e-5, rtol=1e-3)
+
+    def test_pmap_smoother(self):
+        batch_emissions = jnp.stack([self.emissions, 2 * self.emissions])
+        batch_posterior = parallel_lgssm_smoother_batched(self.lgssm_params, batch_emissions)
+        pmap_posterior = parallel_lgssm_smoother_pmap(self.lgssm_params, batch_emissions[None])
+        assert jnp.allclose(batch_posterior.smoothed_means, pmap_posterior.smoothed_means[0], rtol=1e-3)
+        assert jnp.allclose(batch_posterior.smoothed_covariances, pmap_posterior.smoothed_covariances[0],
+                            atol=1e-5, rtol=1e-3)
+
+        batch_filtered_posterior = parallel_lgssm_filter_batched(self.lgssm_params, batch_emissions)
+        pmap_filtered_posterior = parallel_lgssm_filter_pmap(self.lgssm_params, batch_emissions[None])
+        assert jnp.allclose(batch_filtered_posterior.filtered_means, pmap_filtered_posterior.filtered_means[0],
+                            rtol=1e-3)
+        assert jnp.allclose(batch_filtered_posterior.filtered_covariances,
+                            pmap_filtered_posterior.filtered_covariances[0], atol=1e-5, rtol=1e-3)
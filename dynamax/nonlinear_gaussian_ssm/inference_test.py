@@ -68,7 +68,8 @@ def random_lgssm_args(key=0, num_timesteps=15, state_dim=4, emission_dim=2):
 
 
 def to_poly(state, degree):
-    return jnp.concatenate([state**d for d in jnp.arange(degree+1)])
+    powers = jnp.arange(degree+1)
+    return (state[None, :] ** powers[:, None]).reshape(-1)
 
 
 class SimpleNonlinearSSM(SSM):